@@ -9,6 +9,13 @@ import signal
 from .loadConfiguration import loadConfig
 from .taskRunner import runTasks, shutdownTasks
 
+# use the (faster) libuv based event loop if it has been installed
+try :
+  import uvloop
+  uvloop.install()
+except ImportError :
+  pass
+
 def cpawd() :
   """ Parse the command line arguments, load the configuration, and then
   run the tasks using the `asyncio.run` method. """
@@ -51,7 +58,7 @@ def cpawd() :
     """
     print("")
     print("Shutting down...")
-    logger.info("SignalHandler: Caught signal {}".format(signum))
+    logger.info("SignalHandler: Caught signal %s", signum)
     shutdownTasks.set()
 
   loop.set_debug(cliArgs.verbose)
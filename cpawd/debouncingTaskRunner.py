@@ -0,0 +1,437 @@
+""" This cpawd.debouncingTaskRunner module provides the FileLogger and
+DebouncingTaskRunner classes used by the taskRunner module to manage the
+(potentially long running) OS process associated with each watch-do
+task.
+
+See the cpawd.taskRunner module documentation for an overview of how the
+various asyncio.Tasks interact. """
+
+import asyncio
+import fcntl
+import functools
+import logging
+import os
+import shutil
+import time
+
+logger = logging.getLogger("taskRunner")
+
+def writeAll(aFd, someBytes) :
+  """ Write all of someBytes to the file descriptor aFd (os.write may
+  report a partial write). """
+
+  while someBytes :
+    written   = os.write(aFd, someBytes)
+    someBytes = someBytes[written:]
+
+class FileLogger :
+  """ A buffered logger for a task's command.log file.
+
+  Writes accumulate in an in-memory buffer; the buffer is appended to
+  the log file with a single os.write call dispatched to the default
+  (thread pool) executor whenever `flush` is awaited, or whenever
+  `drain` is awaited with more than flushThreshold bytes pending. """
+
+  flushThreshold = 65536
+
+  def __init__(self, logFilePath) :
+    self.logFilePath  = logFilePath
+    self.logFd        = None
+    self.logBuffer    = bytearray()
+    self.pendingWrite = None
+
+  async def open(self) :
+    """ Open the log file.
+
+    The file is opened without O_APPEND (os.splice can not write to an
+    O_APPEND descriptor); since this single descriptor is the only
+    writer, its file offset still gives append semantics. """
+
+    self.logFd = os.open(self.logFilePath, os.O_WRONLY | os.O_CREAT, 0o644)
+
+  def write(self, someText) :
+    """ Append someText to the in-memory buffer. """
+
+    if isinstance(someText, str) :
+      someText = someText.encode()
+    self.logBuffer.extend(someText)
+
+  async def drain(self) :
+    """ Flush the buffer if it has grown past the flush threshold. """
+
+    if self.flushThreshold <= len(self.logBuffer) :
+      await self.flush()
+
+  async def flush(self) :
+    """ Append the buffered text to the log file using a single call on
+    the default executor.
+
+    The executor write is shielded: once the buffer has been
+    snapshotted, a cancelled flush must not lose it (a run's log footer,
+    typically). Any write a cancelled flush left in flight is awaited
+    first, which keeps the writes ordered and makes it safe for close to
+    close the file descriptor. """
+
+    while self.pendingWrite is not None :
+      pendingWrite = self.pendingWrite
+      try :
+        await asyncio.shield(pendingWrite)
+      finally :
+        if pendingWrite.done() and self.pendingWrite is pendingWrite :
+          self.pendingWrite = None
+    if self.logBuffer and self.logFd is not None :
+      bufferedText = bytes(self.logBuffer)
+      self.logBuffer.clear()
+      self.pendingWrite = asyncio.get_running_loop().run_in_executor(
+        None, writeAll, self.logFd, bufferedText
+      )
+      try :
+        await asyncio.shield(self.pendingWrite)
+      finally :
+        if self.pendingWrite is not None and self.pendingWrite.done() :
+          self.pendingWrite = None
+
+  async def close(self) :
+    """ Flush any remaining buffered text and close the log file. """
+
+    try :
+      await self.flush()
+    finally :
+      if self.logFd is not None :
+        os.close(self.logFd)
+        self.logFd = None
+
+class DebouncingTaskRunner :
+  """ Manage the (potentially long running) OS process associated with a
+  single watch-do task, debouncing rapid sequences of restart requests
+  using a single (rescheduled) loop.call_later timer handle.
+
+  An isolated restart request (one arriving more than the debouncing
+  timeout after the last run) fires immediately; only bursts of requests
+  are debounced, and a sustained stream of requests can defer a run by
+  at most the timeout plus maxInterval. While debouncing, each restart
+  merely reschedules the armed timer handle; no Future or Task is
+  allocated until the debounce window actually closes. """
+
+  maxInterval = 0.5
+
+  def __init__(self, timeout, taskName, taskDetails, taskLog, termSignal) :
+    """ Setup the debouncing timeout, task name, task details, task log
+    and termination signal. """
+
+    self.timeout    = timeout
+    self.taskName   = taskName
+    self.taskCmd    = taskDetails['cmd']
+    self.taskDir    = taskDetails['projectDir']
+    self.quiet      = taskDetails.get('quiet', False)
+    # the command, environment and executable path are loop-invariant
+    # for this timer, so resolve and snapshot them once rather than on
+    # every spawn; any task specific env entries are layered over the
+    # parent environment here rather than mutating os.environ
+    self.taskCmd[0] = shutil.which(self.taskCmd[0]) or self.taskCmd[0]
+    self.taskEnv    = { **os.environ, **taskDetails.get('env', {}) }
+    self.taskLog    = taskLog
+    self.termSignal = termSignal
+    self.taskFuture = None
+    self.proc       = None
+    self.retCode    = None
+    self.continueCapturingStdout = True
+    self.loop             = None
+    self.debounceHandle   = None
+    self.maxSleepDeadline = 0.0
+    self.lastRunTime      = 0.0
+
+    # pre-encode the fixed parts of the log banners; only the pid and
+    # timestamp change from run to run
+    self.sepEquals  = b"\n" + b"="*76 + b"\n"
+    self.sepDashes  = b"-"*76 + b"\n"
+
+  @functools.cached_property
+  def taskCmdStr(self) :
+    """ The task's command line as a single string (only materialised
+    when a log header is first written). """
+
+    return " ".join(self.taskCmd)
+
+  @functools.cached_property
+  def cmdBytes(self) :
+    """ The pre-encoded command line written in each log header. """
+
+    return (self.taskCmdStr + "\n").encode()
+
+  def procIsRunning(self) :
+    """ Return True if the task's OS process is still running. """
+
+    return self.proc is not None and self.proc.returncode is None
+
+  async def captureStdout(self) :
+    """ Drain the process's stdout (and stderr) into the task's log in
+    64 KiB chunks.
+
+    Chunks are appended, undecoded, to the log's single reused byte
+    buffer; partial UTF-8 sequences at chunk boundaries pass through to
+    the log byte-for-byte. """
+
+    # bind the loop's bound methods to locals; each saved LOAD_ATTR
+    # matters on chatty subprocesses
+    read  = self.proc.stdout.read
+    write = self.taskLog.write
+    drain = self.taskLog.drain
+    logger.debug("Collecting %s stdout (%s)", self.taskName, self.proc.pid)
+    while self.continueCapturingStdout :
+      aChunk = await read(65536)
+      if not aChunk :
+        break
+      write(aChunk)
+      await drain()
+    logger.debug("Finished collecting %s stdout", self.taskName)
+
+  async def spliceStdout(self, readEnd) :
+    """ Copy the process's stdout directly into the log file using
+    os.splice, so the bytes move from the stdout pipe to the log in
+    kernel space without ever being copied into Python. """
+
+    logger.debug("Splicing %s stdout (%s)", self.taskName, self.proc.pid)
+    loop       = asyncio.get_running_loop()
+    spliceDone = loop.create_future()
+    logFd      = self.taskLog.logFd
+
+    def doSplice() :
+      try :
+        while True :
+          if os.splice(readEnd, logFd, 1048576) == 0 :
+            loop.remove_reader(readEnd)
+            if not spliceDone.done() :
+              spliceDone.set_result(None)
+            return
+      except BlockingIOError :
+        return
+      except OSError as err :
+        loop.remove_reader(readEnd)
+        if not spliceDone.done() :
+          spliceDone.set_exception(err)
+
+    os.set_blocking(readEnd, False)
+    loop.add_reader(readEnd, doSplice)
+    try :
+      await spliceDone
+    finally :
+      loop.remove_reader(readEnd)
+      os.close(readEnd)
+
+  async def runProc(self, readEnd=None) :
+    """ Manage one run of the task's process: write the log header,
+    drain the process's stdout (splicing if readEnd is given, otherwise
+    using chunked reads), wait for its return code and write the log
+    footer. """
+
+    proc      = self.proc
+    taskLog   = self.taskLog
+    startTime = time.strftime("%Y/%m/%d %H:%M:%S")
+    taskLog.write(
+      self.sepEquals
+      + "{} ({}) stdout @ {}\n".format(
+          self.taskName, proc.pid, startTime
+        ).encode()
+      + self.cmdBytes
+      + self.sepDashes
+    )
+
+    if readEnd is not None :
+      # the header must reach the file before any spliced output
+      await taskLog.flush()
+      stdoutCapture = asyncio.create_task(self.spliceStdout(readEnd))
+    else :
+      stdoutCapture = asyncio.create_task(self.captureStdout())
+
+    try :
+      self.retCode = await proc.wait()
+      await stdoutCapture
+    finally :
+      # an interrupted run (cancelled after stopTaskProc has recorded
+      # its retCode) still gets its footer; let any remaining output
+      # land first
+      if not stdoutCapture.done() :
+        try :
+          await stdoutCapture
+        except (Exception, asyncio.CancelledError) :
+          pass
+      finishTime = time.strftime("%Y/%m/%d %H:%M:%S")
+      taskLog.write(
+        self.sepDashes
+        + "{} ({}) finished @ {}\n{} return code: {}\n".format(
+            self.taskName, proc.pid, finishTime, self.taskName, self.retCode
+          ).encode()
+      )
+
+  def fireTask(self) :
+    """ (The debounce timer callback.) The debounce window has closed:
+    start the asyncio.Task which actually runs the task's command. """
+
+    self.debounceHandle = None
+    self.taskFuture     = asyncio.ensure_future(self.taskRunner())
+
+  async def taskRunner(self) :
+    """ Run the task's command capturing its stdout and return code. """
+
+    try :
+      self.lastRunTime = self.loop.time()
+      self.continueCapturingStdout = True
+      if self.quiet :
+        # quiet tasks skip the whole capture machinery: no pipe, no
+        # reader task, no log banners — just the return code
+        self.proc = await asyncio.create_subprocess_exec(
+          *self.taskCmd,
+          cwd=self.taskDir,
+          env=self.taskEnv,
+          stdout=asyncio.subprocess.DEVNULL,
+          stderr=asyncio.subprocess.DEVNULL
+        )
+        logger.debug("Started %s (%s) quietly", self.taskName, self.proc.pid)
+        self.retCode = await self.proc.wait()
+        self.taskLog.write(
+          "{} return code: {}\n".format(self.taskName, self.retCode)
+        )
+        await self.taskLog.flush()
+        return
+      if hasattr(os, 'splice') :
+        # zero-copy path: hand the subprocess the write end of a pipe
+        # and splice the read end straight into the log file
+        readEnd, writeEnd = os.pipe()
+        # enlarge the pipe's kernel buffer (default 64 KiB) so bursts of
+        # output do not block the child while we are between splices
+        try :
+          fcntl.fcntl(writeEnd, fcntl.F_SETPIPE_SZ, 1048576)
+        except (AttributeError, OSError) :
+          pass
+        try :
+          self.proc = await asyncio.create_subprocess_exec(
+            *self.taskCmd,
+            cwd=self.taskDir,
+            env=self.taskEnv,
+            stdout=writeEnd,
+            stderr=asyncio.subprocess.STDOUT
+          )
+        except BaseException :
+          os.close(readEnd)
+          raise
+        finally :
+          os.close(writeEnd)
+      else :
+        readEnd = None
+        self.proc = await asyncio.create_subprocess_exec(
+          *self.taskCmd,
+          cwd=self.taskDir,
+          env=self.taskEnv,
+          limit=1048576,
+          stdout=asyncio.subprocess.PIPE,
+          stderr=asyncio.subprocess.STDOUT
+        )
+      logger.debug("Started %s (%s)", self.taskName, self.proc.pid)
+      await self.runProc(readEnd)
+      await self.taskLog.flush()
+    except asyncio.CancelledError :
+      logger.debug("TaskRunner for %s cancelled", self.taskName)
+      await self.taskLog.flush()
+
+  async def reapTaskFuture(self) :
+    """ Wait for the previous taskRunner to finish, consuming (and
+    debug-logging) its exception, if any, so the event loop never
+    reports it as never retrieved. """
+
+    if self.taskFuture is None :
+      return
+    if not self.taskFuture.done() :
+      try :
+        await self.taskFuture
+      except asyncio.CancelledError :
+        pass
+      except Exception as err :
+        logger.debug("TaskRunner for %s failed: %r", self.taskName, err)
+    elif not self.taskFuture.cancelled() :
+      err = self.taskFuture.exception()
+      if err is not None :
+        logger.debug("TaskRunner for %s failed: %r", self.taskName, err)
+
+  async def reStart(self) :
+    """ (re)Start the task: (re)arm the debounce timer, first stopping
+    any currently running process and waiting for the previous
+    taskRunner to finish. """
+
+    logger.debug("ReStarting task %s", self.taskName)
+    if self.loop is None :
+      self.loop = asyncio.get_running_loop()
+    timeNow      = self.loop.time()
+    sinceLastRun = timeNow - self.lastRunTime
+    if self.timeout <= sinceLastRun :
+      # an isolated change: run immediately, debounce only bursts
+      sleepDeadline = timeNow
+    else :
+      sleepDeadline = timeNow \
+        + min(self.timeout - sinceLastRun, self.maxInterval)
+
+    if self.debounceHandle is not None :
+      # a burst: reschedule the armed timer handle (capped so a
+      # sustained stream of restarts can not defer the run forever);
+      # nothing is stopped and nothing new is allocated
+      self.debounceHandle.cancel()
+      self.debounceHandle = self.loop.call_later(
+        max(min(sleepDeadline, self.maxSleepDeadline) - timeNow, 0),
+        self.fireTask
+      )
+      return
+
+    if self.taskFuture is not None :
+      await self.stopTaskProc()
+      await self.cancelTimer()
+      await self.reapTaskFuture()
+
+    self.maxSleepDeadline = timeNow + self.timeout + self.maxInterval
+    self.debounceHandle   = self.loop.call_later(
+      max(sleepDeadline - timeNow, 0), self.fireTask
+    )
+
+  async def cancelTimer(self) :
+    """ Cancel the debounce timer, disarming the timer handle if one is
+    armed and cancelling any still pending taskRunner.
+
+    Both callers (reStart and the shutdown path) stop the task's process
+    first, so by the time this runs any pending taskFuture is already
+    finishing. """
+
+    if self.debounceHandle is not None :
+      self.debounceHandle.cancel()
+      self.debounceHandle = None
+    if self.taskFuture is not None and not self.taskFuture.done() :
+      self.taskFuture.cancel()
+
+  async def waitOnTask(self) :
+    """ Wait for any armed debounce timer to fire and for the resulting
+    taskRunner to finish (used by watchDo on its way out, so that a
+    runOnce task's single run completes before its log is closed). """
+
+    while self.debounceHandle is not None :
+      await asyncio.sleep(
+        max(self.debounceHandle.when() - self.loop.time(), 0)
+      )
+    await self.reapTaskFuture()
+
+  async def stopTaskProc(self) :
+    """ Stop the task's OS process by sending it the configured
+    termination signal (and killing it outright if it has not exited
+    after 30 seconds). """
+
+    self.continueCapturingStdout = False
+    proc = self.proc
+    if proc is None or proc.returncode is not None :
+      self.retCode = proc.returncode if proc is not None else None
+      return
+    try :
+      proc.send_signal(self.termSignal)
+    except ProcessLookupError :
+      logger.debug("Process for %s already finished", self.taskName)
+    try :
+      await asyncio.wait_for(proc.wait(), 30)
+    except asyncio.TimeoutError :
+      proc.kill()
+    self.retCode = proc.returncode
@@ -0,0 +1,85 @@
+""" This cpawd.fsWatcher module implements a simple recursive file system
+watcher using the asyncinotify library.
+
+Each watch-do task creates one `FSWatcher` instance. Root paths to be
+watched are placed on a queue which is managed by the
+`managePathsToWatchQueue` task; any sub-directories found (or later
+created) under a watched path are themselves added to the queue and
+watched. """
+
+import asyncio
+import os
+
+from asyncinotify import Inotify, Mask
+
+watchMask = (
+  Mask.CREATE | Mask.MODIFY | Mask.DELETE | Mask.MOVE | Mask.ATTRIB
+)
+
+def getMaskName(aMask) :
+  """ Return a human readable name for an (possibly compound)
+  asyncinotify event mask. """
+
+  maskNames = []
+  for aFlag in Mask :
+    if aFlag & aMask :
+      maskNames.append(aFlag.name)
+  return "|".join(maskNames)
+
+class FSWatcher :
+  """ Recursively watch a collection of root paths for file system
+  changes. """
+
+  def __init__(self, logger) :
+    self.logger  = logger
+    self.inotify = Inotify()
+    self.pathsToWatchQueue = asyncio.Queue()
+    self.pathsMgmtTask     = None
+    self.continueWatchingFileSystem = True
+
+  async def watchARootPath(self, aPath) :
+    """ Add aPath to the queue of root paths to be watched. """
+
+    await self.pathsToWatchQueue.put(aPath)
+
+  async def managePathsToWatchQueue(self) :
+    """ Take paths off the paths-to-watch queue, add a watch for each
+    path, and queue any sub-directories so that they too are watched. """
+
+    while True :
+      aPath = await self.pathsToWatchQueue.get()
+      self.logger.debug("Watching path [%s]", aPath)
+      try :
+        self.inotify.add_watch(aPath, watchMask)
+      except Exception as err :
+        self.logger.error("Could not watch path [%s]", aPath)
+        self.logger.error(repr(err))
+      if os.path.isdir(aPath) :
+        with os.scandir(aPath) as dirEntries :
+          for anEntry in dirEntries :
+            if anEntry.is_dir(follow_symlinks=False) :
+              await self.pathsToWatchQueue.put(anEntry.path)
+      self.pathsToWatchQueue.task_done()
+
+  async def watchForFileSystemEvents(self) :
+    """ An async generator which yields file system events for the
+    watched paths. Newly created sub-directories are automatically added
+    to the paths-to-watch queue. """
+
+    while self.continueWatchingFileSystem :
+      try :
+        anEvent = await asyncio.wait_for(self.inotify.get(), 1)
+      except asyncio.TimeoutError :
+        continue
+      if Mask.CREATE & anEvent.mask and Mask.ISDIR & anEvent.mask \
+        and anEvent.path is not None :
+        await self.pathsToWatchQueue.put(str(anEvent.path))
+      yield anEvent
+
+  def stopWatchingFileSystem(self) :
+    """ Signal the watchForFileSystemEvents loop to stop watching for
+    file system events, and cancel the paths-to-watch queue manager. """
+
+    self.continueWatchingFileSystem = False
+    if self.pathsMgmtTask is not None :
+      self.pathsMgmtTask.cancel()
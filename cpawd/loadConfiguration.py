@@ -3,54 +3,141 @@ Load and normalise the cpawd configuration
 
 """
 
-import aiofiles
+import hashlib
+import json
 import os
+from collections import deque
 import shutil
 import sys
+import threading
 import time
-import traceback
 import yaml
 
+# Use the (much faster) LibYAML C loader/dumper whenever it has been
+# compiled into PyYAML, falling back to the pure Python versions.
+try :
+  from yaml import CSafeLoader as YamlSafeLoader
+except ImportError :
+  from yaml import SafeLoader as YamlSafeLoader
+
+try :
+  from yaml import CSafeDumper as YamlSafeDumper
+except ImportError :
+  from yaml import SafeDumper as YamlSafeDumper
+
 def mergeYamlData(yamlData, newYamlData, thePath) :
   """
 
   This is a generic Python merge. It is a *deep* merge and handles both
-  dictionaries and arrays
+  dictionaries and arrays.
+
+  The merge walks an explicit work stack instead of recursing, so deeply
+  nested configurations neither hit the recursion limit nor allocate a
+  path string per nested key (paths are only formatted on the error
+  branches).
 
   """
 
-  if type(yamlData) is None :
+  if yamlData is None :
     print("ERROR yamlData should NEVER be None ")
     sys.exit(-1)
 
-  if type(yamlData) != type(newYamlData) :
-    print("Incompatible types {} and {} while trying to merge YAML data at {}".format(type(yamlData), type(newYamlData), thePath))
-    print("Stoping merge at {}".format(thePath))
-    return
-
-  if type(yamlData) is dict :
-    for key, value in newYamlData.items() :
-      if key not in yamlData :
-        yamlData[key] = value
-      elif type(yamlData[key]) is dict :
-        mergeYamlData(yamlData[key], value, thePath+'.'+key)
-      elif type(yamlData[key]) is list :
-        for aValue in value :
-          yamlData[key].append(aValue)
-      else :
-        yamlData[key] = value
-  elif type(yamlData) is list :
-    for value in newYamlData :
-      yamlData.append(value)
-  else :
+  if not isinstance(yamlData, (dict, list)) :
     print("ERROR yamlData MUST be either a dictionary or an array.")
     sys.exit(-1)
 
-def taskError(message, aTask) :
+  stack = [ (yamlData, newYamlData, thePath) ]
+  while stack :
+    dst, src, aPath = stack.pop()
+
+    if type(dst) != type(src) :
+      print("Incompatible types {} and {} while trying to merge YAML data at {}".format(type(dst), type(src), aPath))
+      print("Stoping merge at {}".format(aPath))
+      continue
+
+    if isinstance(dst, dict) :
+      for key, value in src.items() :
+        if key not in dst :
+          dst[key] = value
+        elif isinstance(dst[key], dict) :
+          stack.append((dst[key], value, "{}.{}".format(aPath, key)))
+        elif isinstance(dst[key], list) :
+          dst[key].extend(value)
+        else :
+          dst[key] = value
+    else :
+      dst.extend(src)
+
+def configCacheFile(configPaths) :
+  """
+
+  Compute the path to the JSON cache of the merged configuration. The
+  cache is located in the user's `~/.cache/cpawd` directory and is keyed
+  on the collection of configuration paths requested.
+
+  """
+
+  pathsHash = hashlib.sha256(
+    '\n'.join(os.path.abspath(aPath) for aPath in configPaths).encode()
+  ).hexdigest()
+  return os.path.join(
+    os.path.expanduser('~'), '.cache', 'cpawd', pathsHash + '.json'
+  )
+
+def loadCachedConfig(cacheFile, candidatePaths) :
+  """
+
+  Load the merged configuration from the JSON cache, providing the cache
+  is still newer than all of the YAML configuration files which produced
+  it. Return None if the cache is missing or stale.
+
+  """
+
+  try :
+    cacheMTime = os.path.getmtime(cacheFile)
+    with open(cacheFile) as aCacheFile :
+      cache = json.load(aCacheFile)
+  except (OSError, ValueError) :
+    return None
+
+  configPaths = cache.get('configPaths', [])
+  for aPath in configPaths :
+    if not os.path.exists(aPath) or cacheMTime < os.path.getmtime(aPath) :
+      return None
+  for aPath in candidatePaths :
+    if os.path.exists(aPath) and os.path.abspath(aPath) not in configPaths :
+      return None
+  return cache.get('config', None)
+
+def saveCachedConfig(cacheFile, configPaths, config) :
+  """
+
+  Cache the merged configuration as JSON so that the next start up with
+  unchanged YAML files can skip the YAML parse completely. The cache is
+  written to a temporary file and atomically renamed into place.
+
+  """
+
+  try :
+    os.makedirs(os.path.dirname(cacheFile), exist_ok=True)
+    tmpCacheFile = cacheFile + '.tmp'
+    with open(tmpCacheFile, 'w') as aCacheFile :
+      json.dump({ 'configPaths' : configPaths, 'config' : config }, aCacheFile)
+    os.replace(tmpCacheFile, cacheFile)
+  except (OSError, TypeError) as err :
+    print("Could not cache the loaded configuration")
+    print(repr(err))
+
+def taskError(message, aTask, relevantKeys=None) :
+  """ Report a fatal problem with a task's configuration, dumping the
+  relevant part of the task description, and exit. """
+
+  if relevantKeys :
+    aTask = { aKey : aTask[aKey] for aKey in relevantKeys if aKey in aTask }
   print("ERROR:")
   print(message)
   print("---------------------------------------------------------")
-  print(yaml.dump(aTask))
+  print(yaml.dump(aTask, Dumper=YamlSafeDumper, default_flow_style=False))
   print("---------------------------------------------------------")
   sys.exit(-1)
 
@@ -90,28 +177,56 @@ def loadConfig(cliArgs) :
     'verbose' : False
   }
 
-  if cliArgs.verbose :
-    config['verbose'] = cliArgs.verbose
-
-  if cliArgs.debug :
-    config['debug'] = cliArgs.debug
+  unLoadedConfig = deque(cliArgs.config)
+  unLoadedConfig.appendleft('cpawdConfig.yaml')
 
-  unLoadedConfig = cliArgs.config.copy()
-  unLoadedConfig.insert(0,'cpawdConfig.yaml')
-  while 0 < len(unLoadedConfig) :
-    aConfigPath = unLoadedConfig[0]
-    del unLoadedConfig[0]
-    if os.path.exists(aConfigPath) :
+  candidateConfigPaths = list(unLoadedConfig)
+  cacheFile    = configCacheFile(candidateConfigPaths)
+  cachedConfig = loadCachedConfig(cacheFile, candidateConfigPaths)
+  if cachedConfig is not None :
+    config = cachedConfig
+  else :
+    loadedConfigPaths = []
+    seenConfigPaths   = set(unLoadedConfig)
+    cacheableConfig   = True
+    while unLoadedConfig :
+      aConfigPath = unLoadedConfig.popleft()
+      if not os.path.exists(aConfigPath) :
+        if aConfigPath not in candidateConfigPaths :
+          # a missing include: the cache's staleness check would never
+          # notice this file appearing, so do not cache (missing
+          # top-level files are covered by the candidate paths check in
+          # loadCachedConfig)
+          cacheableConfig = False
+        continue
       try :
-        with open(aConfigPath) as aConfigFile :
-          aConfig = yaml.safe_load(aConfigFile.read())
+        with open(aConfigPath, 'rb') as aConfigFile :
+          aConfig = yaml.load(aConfigFile, Loader=YamlSafeLoader)
+        # an empty (or all comments) config file parses to None; treat
+        # it as a no-op rather than a load failure
+        if aConfig :
+          # pop any includes off this sub-config *before* merging so the
+          # merged config never accumulates a growing include list
+          for anInclude in aConfig.pop('include', ()) :
+            if anInclude not in seenConfigPaths :
+              seenConfigPaths.add(anInclude)
+              unLoadedConfig.append(anInclude)
           mergeYamlData(config, aConfig, "")
-        if 'include' in config :
-          unLoadedConfig.extend(config['include'])
-          del config['include']
+        loadedConfigPaths.append(os.path.abspath(aConfigPath))
       except Exception as err :
         print("Could not load configuration from [{}]".format(aConfigPath))
         print(err)
+        # caching this partial merge would hide the eventual fix to the
+        # broken file from the staleness check
+        cacheableConfig = False
+    if cacheableConfig :
+      saveCachedConfig(cacheFile, loadedConfigPaths, config)
+
+  if cliArgs.verbose :
+    config['verbose'] = cliArgs.verbose
+
+  if cliArgs.debug :
+    config['debug'] = cliArgs.debug
 
   # create the working directory
   if 'workDir' not in config['workDir'] :
@@ -122,31 +237,40 @@ def loadConfig(cliArgs) :
 
   workDir = config['workDir']['workDir']
 
-  if os.path.exists(workDir) :
-    shutil.rmtree(workDir)
+  # rename any existing work directory out of the way (a single atomic
+  # rename) and remove it in the background while the event loop starts
+  if os.path.lexists(workDir) :
+    oldWorkDir = workDir + '.old.' + str(os.getpid())
+    os.rename(workDir, oldWorkDir)
+    threading.Thread(
+      target=shutil.rmtree, args=(oldWorkDir,),
+      kwargs={ 'ignore_errors' : True }, daemon=True
+    ).start()
   os.makedirs(workDir)
 
   # ensure the task work and project directories exist
   for aTaskName, aTask in config['tasks'].items() :
     aTask['workDir'] = os.path.join(workDir, aTaskName)
-    os.makedirs(aTask['workDir'])
+    os.makedirs(aTask['workDir'], exist_ok=True)
     aTask['logFilePath'] = os.path.join(workDir, aTaskName, 'command.log')
     if 'projectDir' in aTask :
       aTask['projectDir'] = os.path.abspath(os.path.expanduser(aTask['projectDir']))
     else:
       aTask['projectDir'] = aTask['workDir']
 
-    if not os.path.exists(aTask['projectDir']) :
+    try :
+      os.stat(aTask['projectDir'])
+    except FileNotFoundError :
       taskError(
         "the projectDir for task {} MUST exist in the file system".format(aTaskName),
-        aTask
+        aTask, ('projectDir',)
       )
 
     if 'watch' not in aTask or not aTask['watch'] :
       if 'runOnce' in aTask :
         aTask['watch'] = []
       else :
-        taskError("all tasks, which are not runOnce, MUST have a collection of files/directories to watch\nno 'watch' list provided in task [{}]:".format(aTaskName), aTask)
+        taskError("all tasks, which are not runOnce, MUST have a collection of files/directories to watch\nno 'watch' list provided in task [{}]:".format(aTaskName), aTask, ('watch', 'runOnce'))
     expandedWatches = []
     for aWatch in aTask['watch'] :
       newWatch = os.path.expanduser(aWatch)
@@ -154,47 +278,55 @@ def loadConfig(cliArgs) :
         newWatch = os.path.join(aTask['projectDir'], newWatch)
         os.makedirs(newWatch, exist_ok=True)
       expandedWatches.append(newWatch)
-    aTask['watch'] = expandedWatches
+    # canonicalise and deduplicate (preserving order) so overlapping
+    # watch entries do not register duplicate inotify watches
+    aTask['watch'] = list(dict.fromkeys(
+      os.path.realpath(aWatch) for aWatch in expandedWatches
+    ))
 
   # expand toolTips and commands
+  #
+  # format_map reuses this mapping directly instead of re-building a
+  # keyword dict on every .format(**...) call
+  taskMapping = config['tasks']
   for aTaskName, aTask in config['tasks'].items() :
     if 'cmd' not in aTask :
-      taskError("all tasks MUST have a cmd; no cmd provied in task [{}]".format(aTaskName), aTask)
+      taskError("all tasks MUST have a cmd; no cmd provied in task [{}]".format(aTaskName), aTask, ('cmd',))
     if type(aTask['cmd']) is not list :
-      taskError("task cmds MUST be a list of command followed by arguments\nfound type: {} in task {}".format(type(aTask['cmd']), aTaskName), aTask)
+      taskError("task cmds MUST be a list of command followed by arguments\nfound type: {} in task {}".format(type(aTask['cmd']), aTaskName), aTask, ('cmd',))
     try :
       newCmd = []
       for anArgument in aTask['cmd'] :
-        newCmd.append(anArgument.format(**config['tasks']))
+        newCmd.append(anArgument.format_map(taskMapping))
       aTask['cmd'] = newCmd
     except Exception as err :
       print("Could not expand variables in cmd string:")
-      print(yaml.dump(aTask['cmd']))
+      print(yaml.dump(aTask['cmd'], Dumper=YamlSafeDumper, default_flow_style=False))
       print(repr(err))
 
     if 'env' in aTask :
       try :
         newEnv = { }
         for aKey, aValue in aTask['env'].items() :
-          newEnv[aKey] = aValue.format(**config['tasks'])
+          newEnv[aKey] = aValue.format_map(taskMapping)
         aTask['env'] = newEnv
       except Exception as err :
         print("Could not expand variables in env string:")
-        print(yaml.dump(aTask['env']))
+        print(yaml.dump(aTask['env'], Dumper=YamlSafeDumper, default_flow_style=False))
         print(repr(err))
 
     if 'toolTips' in aTask :
       try :
-        aTask['toolTips'] = aTask['toolTips'].format(**config['tasks'])
+        aTask['toolTips'] = aTask['toolTips'].format_map(taskMapping)
       except Exception as err :
         print("Could not expand variables in toolTips string:")
-        print(yaml.dump(aTask['toolTips']))
+        print(yaml.dump(aTask['toolTips'], Dumper=YamlSafeDumper, default_flow_style=False))
         print(repr(err))
 
   if config['verbose'] :
     print("configuration:")
     print("---------------------------------------------------------------")
-    print(yaml.dump(config))
+    print(yaml.dump(config, Dumper=YamlSafeDumper, default_flow_style=False))
 
   # announce User Messages
   print("---------------------------------------------------------------")
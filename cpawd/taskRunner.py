@@ -5,44 +5,47 @@ tasks.
 
 The following description is illustrated in the interaction diagram below.
 
-The top level `runTasks` method initiates an `asyncio.Tasks` running the
-`watchDo` method for each watch-do task. The `watchDo` method `reStart`s
-an `asyncio.Task`, `taskRunner`, via a call to `asyncio.ensure_future`, to
-manage a (potentially long running) OS process. The `watchDo` task
-listens, in an `FSWatcher.watchForFileSystemEvents` loop, for any file
-system changes which might be happening, `reStart`ing the `taskRunner`
-task on any such changes.
-
-The `taskRunner` task starts by sleeping, during which time the
-`taskRunner` task can be cancelled and `reStart`ed (by the `watchDo`
-task). This short timeout period of cancel-able sleep acts as a debouncing
-timer. It allows the `watchDo` task to frequently `reStart` the
-`taskRunner` task without actually running the external OS process until
-any nearly simultaneous file system changes have stopped.
-
-If the `taskRunner` is not cancelled during the sleep, the `taskRunner`
-starts the OS process, using a call to `asyncio.create_subprocess_exec`,
-and then creates two further `asyncio.Tasks`, `captureStdout` and
-`captureRetCode`, to manage the process's output as well as to wait for
-the process's return code.
-
-Once an external OS process has been started, any `reStart` requests from
-the `watchDo` task, signals the `captureStdout` task to stop listening for
-the process's stdout, and then sends a `SIGHUP` signal to the process
-(which *must* respond by gracefully exiting). The `watchDo` task then
-`wait`s on the `taskRunner` task to finish before creating a new
-`taskRunner` task (and potentially repeating this cycle).
+The top level `runTasks` method initiates an `asyncio.Task` running the
+`watchDo` method for each watch-do task. The `watchDo` task listens, in
+an `FSWatcher.watchForFileSystemEvents` loop, for any file system
+changes which might be happening, `reStart`ing its task's
+`DebouncingTaskRunner` on any such changes.
+
+A `reStart` does not create an `asyncio.Task` straight away. Instead it
+arms (or, while a burst of file system events is in progress, simply
+reschedules) a single `loop.call_later` timer handle. This timer handle
+acts as a debouncing timer: it allows the `watchDo` task to frequently
+`reStart` the runner without actually running the external OS process
+until any nearly simultaneous file system changes have stopped. Only
+when the debounce window closes does the timer's `fireTask` callback
+create the `taskRunner` task (via `asyncio.ensure_future`).
+
+The `taskRunner` task starts the OS process, using a call to
+`asyncio.create_subprocess_exec`, and then, in `runProc`, creates one
+further `asyncio.Task` to manage the process's output: `spliceStdout`
+(which moves the process's output to the log file in kernel space using
+`os.splice`) or, where `os.splice` is not available, `captureStdout`
+(which reads the output in 64 KiB chunks). The `taskRunner` itself then
+waits for the process's return code and for the capture task to finish.
+
+Once an external OS process has been started, any `reStart` request from
+the `watchDo` task sends a `SIGHUP` signal to the process (which *must*
+respond by gracefully exiting). The `watchDo` task then `wait`s on the
+`taskRunner` task to finish before re-arming the debounce timer (and
+potentially repeating this cycle).
 
 The `main` `cpawd` task, can at any time request that the `runTasks` task
 shutdown. To shutdown, the `runTasks` task first signals all of the
 `watchDo` `FSWatcher.watchForFileSystemEvents` loops to stop watching for
-file system events. Then the `runTasks` task signals all running
-`taskRunners` to stop.
+file system events. Then the `runTasks` task stops all running task
+processes in parallel, and cancels the debounce timers and `watchDo`
+tasks.
 
 ----
 
 In this interaction diagram, each `asyncio.Task` is represented by the
-function which the task runs. The `OSproc` thread is an external OS
+function which the task runs (`captureStdout` also stands in for its
+`spliceStdout` alternative). The `OSproc` thread is an external OS
 process, which is the ultimate "task" of a given watch-do task.
 
 ```mermaid
@@ -52,7 +55,6 @@ sequenceDiagram
   participant runTasks
   participant watchDo
   participant taskRunner
-  participant captureRetCode
   participant captureStdout
   participant OSproc
 
@@ -64,22 +66,16 @@ sequenceDiagram
 
   activate watchDo
   Note over watchDo,OSproc: running (one watchDo for each watch-do task) ...
-  watchDo-->>watchDo: reStart
+  watchDo-->>watchDo: reStart (arms call_later)
+  Note over watchDo: further reStarts<br/>during the<br/>debounce window<br/>just reschedule<br/>the timer handle
 
-  watchDo-->>watchDo: stopTaskProc
-  Note over watchDo,OSproc: no task/proc running so stopTaskProc does nothing
-
-  watchDo-->>taskRunner: ensure_future
+  watchDo-->>taskRunner: fireTask (ensure_future)
 
   activate taskRunner
-  taskRunner-->>taskRunner: sleep
-  Note over taskRunner: a watchDo reStart<br/>at this point<br/>can cancel<br/>taskRunner<br/>while sleeping
   taskRunner-->>OSproc: exec
   activate OSproc
-  taskRunner-->>captureStdout: wait on created task
+  taskRunner-->>captureStdout: create_task
   activate captureStdout
-  taskRunner-->>captureRetCode: wait on created task
-  activate captureRetCode
 
   OSproc-->>captureStdout: stdout
   OSproc-->>captureStdout: stdout
@@ -89,18 +85,16 @@ sequenceDiagram
   watchDo-->>watchDo: reStart
   watchDo-->>watchDo: stopTaskProc
   watchDo-->>OSproc: send SIGHUP
-  OSproc-->>captureRetCode: finished
+  OSproc-->>taskRunner: return code
   deactivate OSproc
-  captureRetCode-->>taskRunner: finished
-  deactivate captureRetCode
-  watchDo-->>captureStdout: continueCapturingStdout = False
-  captureStdout-->>taskRunner: finished
+  captureStdout-->>taskRunner: end of output
   deactivate captureStdout
   watchDo-->>taskRunner: wait
   taskRunner-->>watchDo: done
   deactivate taskRunner
 
-  watchDo-->>taskRunner: ensure_future
+  watchDo-->>watchDo: reStart (arms call_later)
+  watchDo-->>taskRunner: fireTask (ensure_future)
   activate taskRunner
   Note over taskRunner,OSproc:  new taskRunner starts ...
   taskRunner-->>watchDo: done
@@ -110,7 +104,7 @@ sequenceDiagram
 
   runTasks-->>watchDo: stop listening for<br/>file system events
 
-  runTasks-->>watchDo: stop debouncing timers
+  runTasks-->>watchDo: stop task processes,<br/>cancel debounce timers
   watchDo-->>watchDo: stopTaskProc
 
   watchDo-->>runTasks: done
@@ -131,63 +125,85 @@ sequenceDiagram
 
 import asyncio
 import logging
-import os
 import signal
 
-from cputils.debouncingTaskRunner import FileLogger, DebouncingTaskRunner
-from cputils.fsWatcher import getMaskName, FSWatcher
+from .debouncingTaskRunner import FileLogger, DebouncingTaskRunner
+from .fsWatcher import getMaskName, FSWatcher
 
 logger = logging.getLogger("taskRunner")
 
-watchers         = []
-debouncingTimers = []
+# one registry entry per watch-do task: the task name maps to its
+# (FSWatcher, DebouncingTaskRunner, asyncio.Task) triple
+watchDoTasks = {}
 
 async def watchDo(aTaskName, aTask) :
   """ Setup and manage the watches, and then run the task's command using
   the DebouncingTimer whenever a change is detected in a watched directory
   or file. """
 
-  logger.debug("Starting watchDo for {}".format(aTaskName))
-
-  if 'env' in aTask :
-    for aKey, aValue in aTask['env'].items() :
-      os.environ[aKey] = aValue
+  logger.debug("Starting watchDo for %s", aTaskName)
 
   aWatcher = FSWatcher(logger)
-  watchers.append(aWatcher)
-  taskLog  = FileLogger(aTask['logFilePath'], 5)
+  taskLog  = FileLogger(aTask['logFilePath'])
   await taskLog.open()
   aTimer   = DebouncingTaskRunner(1, aTaskName, aTask, taskLog, signal.SIGHUP)
-  debouncingTimers.append(aTimer)
-
-  # add watches
-  asyncio.create_task(aWatcher.managePathsToWatchQueue())
-  for aWatch in aTask['watch'] :
-    await aWatcher.watchARootPath(aWatch)
-
-  # Ensure the task is run at least once
-  logger.debug("First run of taskRunner for {}".format(aTaskName))
-  await aTimer.reStart()
-
-  # watch and run cmd
-  if 'runOnce' not in aTask :
-    async for event in aWatcher.watchForFileSystemEvents() :
-      logger.debug("File system event mask {} for file [{}] for task {}".format(
-        getMaskName(event.mask), event.name, aTaskName
-      ))
-      await aTimer.reStart()
+  watchDoTasks[aTaskName] = (aWatcher, aTimer, asyncio.current_task())
+
+  # each watchDo task cleans up its own resources on the way out
+  # (whether it finishes normally — runOnce — or is cancelled on
+  # shutdown)
+  try :
+    # add watches
+    #
+    # the watcher keeps a reference to this task: tasks the loop only
+    # holds weakly can be garbage collected mid-run, and holding it lets
+    # stopWatchingFileSystem cancel it cleanly on shutdown
+    aWatcher.pathsMgmtTask = asyncio.create_task(
+      aWatcher.managePathsToWatchQueue(), name="pathMgr:"+aTaskName
+    )
+    for aWatch in aTask['watch'] :
+      await aWatcher.watchARootPath(aWatch)
+
+    # Ensure the task is run at least once
+    logger.debug("First run of taskRunner for %s", aTaskName)
+    await aTimer.reStart()
+
+    # watch and run cmd
+    if 'runOnce' not in aTask :
+      async for event in aWatcher.watchForFileSystemEvents() :
+        if logger.isEnabledFor(logging.DEBUG) :
+          logger.debug("File system event mask %s for file [%s] for task %s",
+            getMaskName(event.mask), event.name, aTaskName
+          )
+        await aTimer.reStart()
+  finally :
+    aWatcher.stopWatchingFileSystem()
+    await aTimer.waitOnTask()
+    await taskLog.close()
 
 async def stopTasks() :
   """Stop all watch-do tasks"""
 
   logger.info("Stopping all tasks")
 
-  for aWatcher in watchers :
+  for aWatcher, _, _ in watchDoTasks.values() :
     aWatcher.stopWatchingFileSystem()
 
-  for aTimer in debouncingTimers :
-    await aTimer.stopTaskProc()
+  # fan out the (potentially slow) process stops in parallel; shutdown
+  # then takes as long as the slowest task rather than the sum of all
+  await asyncio.gather(
+    *(aTimer.stopTaskProc() for _, aTimer, _ in watchDoTasks.values()),
+    return_exceptions=True
+  )
+  for aWatcher, aTimer, aWatchDoTask in watchDoTasks.values() :
     await aTimer.cancelTimer()
+    aWatchDoTask.cancel()
+  await asyncio.gather(
+    *(aWatchDoTask for _, _, aWatchDoTask in watchDoTasks.values()),
+    *(aWatcher.pathsMgmtTask for aWatcher, _, _ in watchDoTasks.values()
+      if aWatcher.pathsMgmtTask is not None),
+    return_exceptions=True
+  )
 
   logger.debug("All tasks Stoped")
 
@@ -208,5 +224,5 @@ async def runTasks(config) :
   "run" in parallel. """
 
   for aTaskName, aTask in config['tasks'].items() :
-    asyncio.create_task(watchDo(aTaskName, aTask))
+    asyncio.create_task(watchDo(aTaskName, aTask), name="watchDo:"+aTaskName)
   await waitForShutdown()